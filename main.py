@@ -6,123 +6,285 @@ The program will check for file size and make decision to compress it or not, th
 This program main purpose is to be used as a steam and epic games backup.
 """
 
-from utils import get_file_hash, compress_selected_files, load_metadata, save_metadata, SKIP_EXT
-from multi_thread import multi_hash, multi_copy
+from utils import get_file_hash, iter_files, compress_tar_zst, load_metadata, save_metadata, store_blob, restore_manifest, write_zip_member, new_progress, set_quiet, Throttle, SKIP_EXT, WRITE_BUFFER_SIZE
+from multi_thread import multi_hash
 
 import multiprocessing
 import time
 import os
 import shutil
 import zipfile
+from enum import Enum
 from tempfile import TemporaryDirectory
 from pathlib import Path
+from typing import Annotated
 from rich import print
-from rich.progress import Progress, BarColumn, TextColumn
+from rich.progress import BarColumn, TextColumn
 
 import typer
 
 app = typer.Typer(no_args_is_help=True)
 
 
+class ArchiveFormat(str, Enum):
+    ZST = "zst"
+    ZIP = "zip"
+    STORE = "store"
+
+
+def unique_path(folder: Path, stem: str, suffix: str) -> Path:
+    """
+    First free folder/stem+suffix, with _1, _2... after the stem when taken,
+    so two backups in the same second never overwrite each other.
+    """
+    path = folder.joinpath(f"{stem}{suffix}")
+    count = 0
+    while path.exists():
+        count += 1
+        path = folder.joinpath(f"{stem}_{count}{suffix}")
+    return path
+
+
 @app.command(no_args_is_help=True)
-def backup(source: Path, destination: Path, meta_path: Path | None = None):
+def backup(
+    source: Path,
+    destination: Path,
+    meta_path: Path | None = None,
+    archive_format: Annotated[ArchiveFormat, typer.Option("--format")] = ArchiveFormat.ZST,
+    quiet: Annotated[bool, typer.Option("--quiet", "-q")] = False,
+):
     """
     Backup your file or folder.
 
     --source        : "C:/Program Files/HWiNFO64/HWiNFO Manual.pdf"
 
     --destination   : "C:/Program Files"
+
+    --format        : "zst" (tar + zstd, default), "zip" or "store" (deduplicated objects)
+
+    --quiet         : No progress bars, for scheduled backups
     """
     start_time = time.time()
+    set_quiet(quiet)
     source = source.resolve()
     destination = destination.resolve()
     print(f"[cyan]• Source : [bold]{source.name}")
     print(f"[cyan]• Destination : [bold]{destination.name}")
     destination = destination.joinpath(f"{source.name}_backup")
-    meta_fname = f"{source.name}_meta.json"
+    is_file = source.is_file()
 
-    if source.is_file():  # === File Compression and Zipped ===
-        print(f"[green][+] [cyan]Source is a [bold]file[/bold].")
-        if meta_path:
-            meta_file = meta_path.joinpath(meta_fname)
-        else:
-            meta_file = destination.joinpath(meta_fname)
+    # === Metadata path, built once for either branch
+    if meta_path is None:
+        meta_path = destination if is_file else destination.parent
+    meta_file = meta_path.joinpath(f"{source.name}_meta.json")
 
+    suffix = {
+        ArchiveFormat.ZST: ".tar.zst",
+        ArchiveFormat.ZIP: ".zip",
+        ArchiveFormat.STORE: ".json",
+    }[archive_format]
+
+    if is_file:  # === File Compression and Zipped ===
+        print(f"[green][+] [cyan]Source is a [bold]file[/bold].")
         destination.mkdir(exist_ok=True)
         metadata = load_metadata(meta_file)
+        cached = metadata.get(source.name) or {}
+        if isinstance(cached, str):  # older metadata only kept the hash
+            cached = {"hash": cached}
+
+        # === Only an existing archive in the same format is up to date
+        up_to_date = cached.get("format") == archive_format.value and \
+            destination.joinpath(cached.get("archive", "")).is_file()
+
+        # === Same size and mtime means same file, no need to read it
+        stat = source.stat()
+        if up_to_date and (cached.get("size"), cached.get("mtime_ns")) == (stat.st_size, stat.st_mtime_ns):
+            return print(f"[green]No change detected.")
         file_hash = get_file_hash(source)
-        if metadata.get(source.name) == file_hash:
+        target = destination.joinpath(f"{source.name}{suffix}")
+        if archive_format is ArchiveFormat.STORE and target.exists():
+            # === Keep the earlier snapshots, each manifest restores alone
+            target = unique_path(
+                destination,
+                f"{source.name}_{time.strftime('%Y%m%d_%H%M%S')}",
+                suffix
+            )
+        entry = {
+            "hash": file_hash,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "format": archive_format.value,
+            "archive": target.name
+        }
+        if up_to_date and cached.get("hash") == file_hash:  # touched, content is the same
+            entry["archive"] = cached["archive"]
+            metadata[source.name] = entry
+            save_metadata(meta_file, metadata)
             return print(f"[green]No change detected.")
-        compress_selected_files(source, destination)
-        metadata[source.name] = file_hash
+        if archive_format is ArchiveFormat.ZST:
+            compress_tar_zst([(source.name, source, stat.st_size)], target)
+        elif archive_format is ArchiveFormat.STORE:
+            store_blob(
+                source,
+                destination.joinpath("objects"),
+                file_hash,
+                source.suffix.lower() not in SKIP_EXT
+            )
+            save_metadata(target, {"hashes": {source.name: file_hash}})
+        else:
+            with zipfile.ZipFile(target, "w") as zipf:
+                write_zip_member(
+                    zipf,
+                    source,
+                    source.name,
+                    zipfile.ZIP_STORED if source.suffix.lower() in SKIP_EXT
+                    else zipfile.ZIP_DEFLATED
+                )
+        metadata[source.name] = entry
         save_metadata(meta_file, metadata)
-        return print(["[green]File successfully compressed."])
+        return print(f"[green]File successfully compressed.")
 
     print(f"[green][+] [cyan]Source is a [bold]folder[/bold].")
+    with os.scandir(source) as it:  # stops at the first entry
+        if next(it, None) is None:
+            return print(f"[yellow]Source folder is empty, nothing to back up.")
+
+    # === Previous manifest, a delta is only possible on top of a base archive
+    previous = load_metadata(meta_file)
+    base = previous.get("base")
+    if archive_format is ArchiveFormat.STORE:
+        # === Manifests are full snapshots, objects/ already dedups the data
+        base = None
+    elif base and not destination.parent.joinpath(base).exists():
+        print(f"[yellow]Base archive [bold]{base}[/bold] is missing, "
+              "doing a full backup.")
+        base = None
+    elif base and previous.get("format") != archive_format.value:
+        print(f"[yellow]Base archive [bold]{base}[/bold] was made with another "
+              "--format, doing a full backup.")
+        base = None
+
     with TemporaryDirectory() as temp_dir:
         temp_path = Path(temp_dir)
-        temp_compressed = temp_path.joinpath(f"{source.name}_compressed.zip")
-        temp_meta_path = temp_path.joinpath(f"metadata")
+        temp_meta_path = temp_path.joinpath("metadata")
         temp_meta_path.mkdir(exist_ok=True)
+        temp_meta_file = temp_meta_path.joinpath(
+            f"{source.name}_metadata.json")
 
         metadata = {}
-        files = [f for f in source.rglob("*") if f.is_file()]
-        hashes, to_zip, to_copy = multi_hash(files, source)
+        files = {
+            Path(entry.path): entry.stat()
+            for entry in iter_files(source)
+        }
+        # === Files with the same size and mtime as last time keep their hash
+        old_stats = previous.get("stats", {})
+        cache = {
+            arcname: [file_hash, *old_stats[arcname]]
+            for arcname, file_hash in previous.get("hashes", {}).items()
+            if arcname in old_stats
+        }
+        # === Store format writes its blobs while the hashing is still going
+        objects = destination.parent.joinpath("objects") \
+            if archive_format is ArchiveFormat.STORE else None
+        hashes, to_zip, to_copy, stats = multi_hash(
+            files, source, cache, objects)
 
-        multi_copy(to_copy, temp_path)  # === Copying files
         metadata['hashes'] = hashes       # === Hashes metadata
-        save_metadata(
-            temp_meta_path.joinpath(f"{source.name}_metadata.json"),
-            metadata
-        )
-        with Progress(
-            BarColumn(),
-            "•",
-            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-            "•",
-            TextColumn("[progress.description]{task.description}"),
-        ) as progress:
-            compress_task = progress.add_task(
-                "[yellow]Compressing files...", total=len(to_zip))
-            with zipfile.ZipFile(
-                temp_compressed,
-                "w",
+        if base:
+            # === Only keep files that changed since the last backup
+            old_hashes = previous.get("hashes", {})
+            removed = sorted(old_hashes.keys() - hashes.keys())
+            to_zip = [(a, f) for a, f in to_zip if old_hashes.get(a) != hashes[a]]
+            to_copy = [(a, f) for a, f in to_copy if old_hashes.get(a) != hashes[a]]
+            if not (to_zip or to_copy or removed):
+                # === Touched files keep their hash, refresh their mtime
+                previous["hashes"] = hashes
+                previous["stats"] = stats
+                save_metadata(meta_file, previous)
+                return print(f"[green]No change detected.")
+
+            timestamp = time.strftime("%Y%m%d_%H%M%S")
+            destination = unique_path(
+                destination.parent,
+                f"{destination.name}_{timestamp}",
+                f".delta{suffix}"
+            )
+            metadata['base'] = base
+            metadata['removed'] = removed
+            print(f"[cyan]• Delta : [bold]{len(to_zip) + len(to_copy)}[/bold] "
+                  f"changed, [bold]{len(removed)}[/bold] removed.")
+        else:
+            stem = destination.name
+            destination = destination.with_name(f"{stem}{suffix}")
+            if archive_format is ArchiveFormat.STORE and destination.exists():
+                # === Keep the earlier snapshots, each manifest restores alone
+                destination = unique_path(
+                    destination.parent,
+                    f"{stem}_{time.strftime('%Y%m%d_%H%M%S')}",
+                    suffix
+                )
+        save_metadata(temp_meta_file, metadata)
+
+        if archive_format is ArchiveFormat.STORE:
+            # === Content addressed, blobs are already in place from multi_hash
+            save_metadata(destination, metadata)
+        elif archive_format is ArchiveFormat.ZST:
+            # === Single tar.zst stream, no staging copies needed
+            compress_tar_zst(
+                [(arcname, file, files[file].st_size)
+                 for arcname, file in sorted(to_zip + to_copy)] + [
+                    (f"metadata/{temp_meta_file.name}", temp_meta_file,
+                     temp_meta_file.stat().st_size)
+                ],
+                destination
+            )
+        else:
+            # === One zip, SKIP_EXT files stored as is, the rest deflated
+            members = sorted(
+                [(arcname, file, zipfile.ZIP_DEFLATED) for arcname, file in to_zip]
+                + [(arcname, file, zipfile.ZIP_STORED) for arcname, file in to_copy]
+            )
+            members.append((
+                f"metadata/{temp_meta_file.name}",
+                temp_meta_file,
                 zipfile.ZIP_DEFLATED
-            ) as zipf:
-                for arcname, file in to_zip:
-                    zipf.write(file, arcname)
-                    progress.update(
-                        compress_task,
-                        description=f"[yellow]Compressed [bold]{file.name}.",
-                        advance=1
-                    )
-
-        # === Storing process
-        with Progress(
-            BarColumn(),
-            "•",
-            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-            "•",
-            TextColumn("[progress.description]{task.description}"),
-        ) as progress:
-            store_task = progress.add_task("[yellow]Storing files...", total=sum(
-                len(files) for _, _, files in os.walk(temp_path)))
-
-            with zipfile.ZipFile(
-                destination.with_suffix(".zip"),
-                "w",
-                zipfile.ZIP_STORED
-            ) as zf:
-                for root, _, files in os.walk(temp_path):
-                    for file in files:
-                        fpath = Path(root).joinpath(file)
-                        arcname = fpath.relative_to(temp_path)
-                        zf.write(fpath, arcname)
-                        progress.update(
-                            store_task,
-                            description=f"[yellow]Moved [bold]{fpath.name}.",
-                            advance=1
-                        )
+            ))
+            with new_progress(
+                BarColumn(),
+                "•",
+                TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+                "•",
+                TextColumn("[progress.description]{task.description}"),
+            ) as progress:
+                throttle = Throttle()
+                compress_task = progress.add_task(
+                    "[yellow]Compressing files...", total=len(members))
+                with open(
+                    destination, "wb", buffering=WRITE_BUFFER_SIZE
+                ) as fh, zipfile.ZipFile(fh, "w") as zipf:
+                    for arcname, file, compress_type in members:
+                        write_zip_member(zipf, file, arcname, compress_type)
+                        progress.advance(compress_task)
+                        if throttle.ready():
+                            progress.update(
+                                compress_task,
+                                description=f"[yellow]Compressed [bold]{file.name}."
+                            )
+
+    # === Remember the new state, deltas are chained on top of the base
+    if base:
+        deltas = previous.setdefault("deltas", [])
+        if destination.name not in deltas:
+            deltas.append(destination.name)
+    else:
+        previous = {
+            "base": destination.name,
+            "deltas": [],
+            "format": archive_format.value
+        }
+    previous["hashes"] = hashes
+    previous["stats"] = stats
+    save_metadata(meta_file, previous)
 
     elapse = time.time() - start_time
     print(f"[cyan]• Destination : [bold green]{destination}")
@@ -132,8 +294,34 @@ def backup(source: Path, destination: Path, meta_path: Path | None = None):
 
 
 @app.command(no_args_is_help=True)
-def restore(source: Path, destination: Path):
-    return
+def restore(
+    source: Path,
+    destination: Path,
+    quiet: Annotated[bool, typer.Option("--quiet", "-q")] = False,
+):
+    """
+    Restore a backup made with --format store.
+
+    --source        : "D:/Backup/Steam_backup.json"
+
+    --destination   : "C:/Program Files (x86)/Steam"
+
+    --quiet         : No progress bars
+    """
+    start_time = time.time()
+    set_quiet(quiet)
+    source = source.resolve()
+    destination = destination.resolve()
+    if source.suffix != ".json":
+        return print(f"[red]Only [bold]--format store[/bold] manifests (.json) can be restored for now.")
+
+    print(f"[cyan]• Manifest : [bold]{source.name}")
+    destination.mkdir(parents=True, exist_ok=True)
+    restore_manifest(source, destination)
+
+    elapse = time.time() - start_time
+    print(f"[cyan]• Destination : [bold green]{destination}")
+    print(f"[cyan]{f" {elapse:.2f} Second ":=^80}")
 
 
 if __name__ == "__main__":
@@ -1,15 +1,21 @@
-from utils import SKIP_EXT, get_file_hash
+from utils import SKIP_EXT, Throttle, get_file_hash, store_blob, new_progress
 
-import shutil
+import os
 from pathlib import Path
-from rich.progress import Progress, BarColumn, TextColumn
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from rich.progress import BarColumn, TextColumn
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# Hashing and blob storing (zstd, file clones) release the GIL, so threads
+# do the job without the pickling and process spawn cost (spawn is the
+# default on Windows).
+MAX_WORKERS = min(32, (os.cpu_count() or 4) * 2)
+STORE_WORKERS = min(8, os.cpu_count() or 1)  # zstd is CPU bound, keep it to the cores
 
-def process_file(file: Path, source: Path) -> tuple[str, str | None, Path | None]:
+
+def process_file(file: Path, arcname: str, stat: os.stat_result, cached: list | None = None) -> tuple[str, str | None, Path | None]:
     """
     Process a single file:
-    - Compute hash
+    - Compute hash, or reuse the cached one if size and mtime still match
     - If compressible, return arcname + file path for later zipping
     - If skipped, return path for copying
 
@@ -17,45 +23,52 @@ def process_file(file: Path, source: Path) -> tuple[str, str | None, Path | None
 
     Full path to the corresponding file.
 
-    :params: source: Path
+    :params: arcname: str
+
+    Path of the file relative to the backup root.
+
+    :params: stat: os.stat_result
 
-    Root path of the file.
+    Stat of the file, taken during the walk.
+
+    :params: cached: [hash, size, mtime_ns] | None
+
+    Entry from the previous backup, if any.
 
     :return: tuple(arcname, file hash)
     """
-    arcname = file.relative_to(source)
-    file_hash = get_file_hash(file)
+    if cached and cached[1:] == [stat.st_size, stat.st_mtime_ns]:
+        file_hash = cached[0]  # untouched since the last backup, skip reading
+    else:
+        file_hash = get_file_hash(file)
 
     if file.suffix.lower() not in SKIP_EXT:
         # compressible file → return for zip writing
-        return (str(arcname), file_hash, file)
+        return (arcname, file_hash, file)
     else:
         # skipped → must copy later
-        return (str(arcname), file_hash, None)
+        return (arcname, file_hash, None)
 
 
-def copy_file(file: tuple[str, Path], destination: Path) -> tuple[str, Path]:
-    arcname, fpath = file
-    destination = destination.joinpath(arcname)
-    destination.parent.mkdir(parents=True, exist_ok=True)
-
-    shutil.copy2(
-        fpath,
-        destination
-    )
+def multi_hash(files: dict[Path, os.stat_result], source: Path, cache: dict | None = None, objects: Path | None = None) -> tuple[dict, list[tuple[str, Path]], list[tuple[str, Path]], dict]:
+    """
+    :params: files: file path to its stat from the walk
 
-    return file
+    :params: cache: arcname to [hash, size, mtime_ns] from the previous backup
 
+    :params: objects: object store root, when given every file is stored
+        there as soon as its hash is known, while the rest are still hashing
 
-def multi_hash(files: list[Path] | tuple[Path], source: Path) -> tuple[dict, list[tuple[str, Path]], list[tuple[str, Path]]]:
-    """
-    :return: tuple(hashes, to_zip, to_copy)
+    :return: tuple(hashes, to_zip, to_copy, stats), stats maps arcname to
+        [size, mtime_ns] for the next backup's cache
     """
     hashes = {}
+    stats = {}
     to_zip = []
     to_copy = []
+    cache = cache or {}
 
-    with Progress(
+    with new_progress(
         BarColumn(),
         "•",
         TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
@@ -66,48 +79,54 @@ def multi_hash(files: list[Path] | tuple[Path], source: Path) -> tuple[dict, lis
             "[yellow]Hashing and classifying files...", total=len(files)
         )
 
-        # Multi threaded
-        with ProcessPoolExecutor() as executor:
-            futures = {executor.submit(
-                process_file, f, source): f for f in files}
-
+        # Arcnames are sliced off a fixed prefix instead of a relative_to()
+        # per file
+        root_len = len(os.path.join(source, ""))
+
+        # Multi threaded, storing runs in its own pool next to the hashing
+        stored = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+                ThreadPoolExecutor(max_workers=STORE_WORKERS) as store_executor:
+            # Biggest files first, so no large file starts last and leaves the
+            # other workers idle at the end
+            futures = {}
+            for f, st in sorted(
+                files.items(), key=lambda item: item[1].st_size, reverse=True
+            ):
+                arcname = str(f)[root_len:]
+                stats[arcname] = [st.st_size, st.st_mtime_ns]
+                futures[executor.submit(
+                    process_file, f, arcname, st, cache.get(arcname))] = f
+
+            throttle = Throttle()
             for fut in as_completed(futures):
                 arcname, hsh, compressible = fut.result()
                 hashes[arcname] = hsh
 
                 if compressible:
                     to_zip.append((arcname, compressible))
-                    desc = f"[green]Ready to compress [bold]{compressible.name}"
                 else:
                     to_copy.append((arcname, futures[fut]))
-                    desc = f"[blue]Marked for copy [bold]{futures[fut].name}"
-
-                progress.update(task, advance=1, description=desc)
-
-        return (hashes, to_zip, to_copy)
 
-
-def multi_copy(files: list | tuple[Path], destination: Path):
-    with Progress(
-        BarColumn(),
-        "•",
-        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-        "•",
-        TextColumn("[progress.description]{task.description}"),
-    ) as progress:
-        task = progress.add_task(
-            "[yellow]Copying file...",
-            total=len(files)
-        )
-
-        with ProcessPoolExecutor() as executor:
-            futures = {executor.submit(
-                copy_file, f, destination): f for f in files}  # type: ignore
-
-            for fut in as_completed(futures):
-                arcname, _ = fut.result()
-                progress.update(
-                    task,
-                    description=f"[yellow]Copied [bold]{arcname}.",
-                    advance=1
-                )
+                # One job per unique content, so no two workers write the
+                # same blob
+                if objects is not None and hsh not in stored:
+                    stored[hsh] = store_executor.submit(
+                        store_blob, futures[fut], objects, hsh, compressible is not None)
+
+                progress.advance(task)
+                if throttle.ready():
+                    progress.update(
+                        task, description=f"[yellow]Hashed [bold]{futures[fut].name}")
+
+            if stored:
+                store_task = progress.add_task(
+                    "[yellow]Storing files...", total=len(stored))
+                for fut in as_completed(stored.values()):
+                    blob = fut.result()
+                    progress.advance(store_task)
+                    if throttle.ready():
+                        progress.update(
+                            store_task, description=f"[yellow]Stored [bold]{blob.name}.")
+
+        return (hashes, to_zip, to_copy, stats)
@@ -1,73 +1,225 @@
+import io
 import os
 import json
+import shutil
+import threading
 import py7zr
+import tarfile
 import tempfile
 import time
-from multiprocessing import Manager
+import zipfile
+from queue import Queue
 from rich import print
 from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn, TransferSpeedColumn
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from blake3 import blake3
+import zstandard as zstd
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # Optional speedup, stdlib json gives the same output
+    orjson = None
+
+try:
+    from isal import isal_zlib
+    zipfile.zlib = isal_zlib  # ISA-L DEFLATE, same zip output, much faster
+    zipfile.crc32 = isal_zlib.crc32  # zipfile bound zlib's crc32 at import
+except ImportError:  # Optional speedup, stdlib zlib is used as is
+    pass
 
 CHUNK_SIZE = 16 * 1024 * 1024  # 16 MB
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024  # 4 MB, coalesces small archive writes
+
+
+class Throttle:
+    """
+    Rate limit for progress descriptions.
+
+    Formatting and re-rendering a description for every file is measurable
+    on trees with thousands of tiny files, so only advance per file and
+    refresh the text when ready() allows it.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.last = 0.0
+
+    def ready(self) -> bool:
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return False
+        self.last = now
+        return True
+
+
+QUIET = False  # --quiet, progress bars are skipped entirely
+
+
+class _NullProgress:
+    """
+    Stand-in for rich Progress under --quiet, every call is a no-op so the
+    loops run without any rendering or locking.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_task(self, *args, **kwargs) -> int:
+        return 0
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def advance(self, *args, **kwargs):
+        pass
+
+
+def set_quiet(quiet: bool):
+    global QUIET
+    QUIET = quiet
+
+
+def new_progress(*columns, **kwargs) -> Progress | _NullProgress:
+    """Rich Progress with the given columns, or a no-op one under --quiet."""
+    if QUIET:
+        return _NullProgress()
+    return Progress(*columns, **kwargs)
+
+
+FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)
+FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", None)
+
+
+def fadvise(f, advice: int | None):
+    """
+    Tell the kernel how an open file is going to be used. SEQUENTIAL
+    before a long read doubles the readahead, DONTNEED once done drops the
+    pages so a backup does not push everything else out of the cache.
+    A no-op where posix_fadvise is missing (Windows, macOS).
+    """
+    if advice is not None:
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, advice)
+        except OSError:
+            pass  # only a hint
+
+
+def get_file_digest(path: Path) -> bytes:
+    """Return the raw 32 byte BLAKE3 digest of a single file."""
+    # update_mmap maps the file and hashes it across blake3's own thread
+    # pool (AUTO), no Python read loop or bytes copy per chunk. blake3
+    # falls back to plain reads itself when a file can't be mapped.
+    hasher = blake3(max_threads=blake3.AUTO)
+    hasher.update_mmap(path)
+    return hasher.digest()
 
 
 def get_file_hash(path: Path) -> str:
     """Return BLAKE3 hash of a single file."""
-    hasher = blake3()
-    with open(path, "rb") as f:
-        while chunk := f.read(CHUNK_SIZE):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+    return get_file_digest(path).hex()
+
+
+def iter_files(root) -> Iterator[os.DirEntry]:
+    """
+    Yield a DirEntry for every file under root.
+
+    os.scandir hands back the file type with the directory listing, so
+    unlike rglob + is_file() there is no extra stat per entry. Symlinked
+    folders are not followed, same as rglob.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
 
 
 def get_folder_hash(path: Path, workers: int = max(1, os.cpu_count() or 1)) -> str:
-    """Return combined BLAKE3 hash of all files in a folder."""
+    """
+    Return combined BLAKE3 hash of all files in a folder.
+
+    blake3 releases the GIL while hashing, so threads are enough here and
+    avoid the process spawn cost.
+    """
     hasher = blake3()
 
     # Collect all files
-    files = []
-    for root, _, filenames in os.walk(path):
-        for fname in filenames:
-            files.append(os.path.join(root, fname))
-    files.sort()  # ensure consistent ordering
+    sizes = {entry.path: entry.stat().st_size for entry in iter_files(path)}
+    files = sorted(sizes)  # ensure consistent ordering
     total_files = len(files)
 
-    with Progress(
+    with new_progress(
         BarColumn(),
         TextColumn("[progress.description]{task.description}"),
         transient=True
-    ) as progress, ProcessPoolExecutor(max_workers=workers) as executor:
+    ) as progress, ThreadPoolExecutor(max_workers=workers) as executor:
 
         task = progress.add_task("Hashing files...", total=total_files)
 
-        # Dispatch hashing jobs
-        futures = {executor.submit(get_file_hash, f): f for f in files}
+        # Dispatch hashing jobs, biggest first to avoid a long tail
+        futures = {
+            executor.submit(get_file_digest, f): f
+            for f in sorted(files, key=sizes.get, reverse=True)
+        }
 
+        digests = {}
+        throttle = Throttle()
         for future in as_completed(futures):
             fpath = futures[future]
             try:
-                file_hash = future.result()
-                hasher.update(file_hash.encode())
+                digests[fpath] = future.result()
             except Exception as e:
                 print(f"[!] Failed to hash {fpath}: {e}")
-            progress.update(
-                task, advance=1, description=f"[blue]Hashing [yellow]{fpath[:80]}...")
-
+            progress.advance(task)
+            if throttle.ready():
+                progress.update(
+                    task, description=f"[blue]Hashing [yellow]{fpath[:80]}...")
+
+    # Raw digests, combined in path order so completion order doesn't matter
+    for fpath in files:
+        if fpath in digests:
+            hasher.update(digests[fpath])
     return hasher.hexdigest()
 
 
 def load_metadata(meta_file) -> dict:
     if os.path.exists(meta_file):
-        with open(meta_file, "r") as f:
-            return json.load(f)
+        # Bytes either way, orjson writes raw UTF-8 and json.loads detects it
+        # instead of going through the locale encoding (cp1252 on Windows)
+        with open(meta_file, "rb") as f:
+            data = f.read()
+        return orjson.loads(data) if orjson else json.loads(data)
     return {}
 
 
 def save_metadata(meta_file, data):
-    with open(meta_file, "w") as f:
-        json.dump(data, f, indent=2)
+    """
+    Write metadata atomically, a crash never leaves a truncated file.
+    Keys are sorted so the same state always gives the same bytes.
+    """
+    temp = f"{meta_file}.tmp"
+    with open(temp, "wb") as f:
+        if orjson:
+            f.write(orjson.dumps(
+                data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+        else:
+            f.write(json.dumps(data, indent=2, sort_keys=True).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, meta_file)
 
 
 def get_size(path) -> int:
@@ -84,16 +236,13 @@ def get_size(path) -> int:
     """
     if os.path.isfile(path):
         return os.path.getsize(path)
-    total_size = 0
-    for dirpath, _, filenames in os.walk(path):
-        for f in filenames:
-            total_size += os.path.getsize(os.path.join(dirpath, f))
-    return total_size
+    # The stat comes with the directory entry, no second lookup per file
+    return sum(entry.stat().st_size for entry in iter_files(path))
 
 
 # ============ 7 ZIP ============
 
-SKIP_EXT = {
+SKIP_EXT = frozenset({  # lowercase, checked against suffix.lower()
     # Audio
     ".mp3", ".aac", ".ogg", ".opus", ".flac", ".wma", ".m4a",
 
@@ -112,27 +261,114 @@ SKIP_EXT = {
 
     # Documents
     ".pdf", ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".odp"
-}
+})
 
 
-def compress_selected_files(src_folder: Path, dest: Path, skip_ext: set = SKIP_EXT):
+def compress_selected_files(src_folder: Path, dest: Path, skip_ext: frozenset = SKIP_EXT):
     """
     Compress selected files into a .7z archive.
     """
-    with py7zr.SevenZipFile(dest, 'w') as archive, Progress() as progress:
+    with py7zr.SevenZipFile(dest, 'w') as archive, new_progress() as progress:
         # Collect all files first
-        files = [f for f in src_folder.rglob("*") if f.is_file()]
+        files = [Path(entry.path) for entry in iter_files(src_folder)]
         task = progress.add_task(
             "[cyan]Compressing files...", total=len(files))
 
+        throttle = Throttle()
         for file in files:
             if file.suffix.lower() not in skip_ext:
                 rel_path = file.relative_to(src_folder)
                 archive.write(file, arcname=str(rel_path))
-                progress.console.log(f"✔ Added: {rel_path}")
+                desc = f"[cyan]✔ Added [bold]{rel_path}"
             else:
-                progress.console.log(f"⏩ Skipped: {file}")
-            progress.update(task, advance=1)
+                desc = f"[cyan]⏩ Skipped [bold]{file.name}"
+            progress.advance(task)
+            if throttle.ready():
+                progress.update(task, description=desc)
+
+
+# ============ ZSTANDARD ============
+
+ZSTD_LEVEL = 3
+PREFETCH_SIZE = 8 * 1024 * 1024  # Files up to 8 MB are read ahead in memory
+
+
+def _prefetch_files(files: list[tuple[str, Path, int]], queue: Queue):
+    """
+    Read small files ahead of the compressor, bigger ones are left to it.
+
+    Always ends with a None sentinel. Read errors are not raised here, the
+    file is handed over unread so the writer raises it on its own thread.
+    """
+    try:
+        for arcname, file, size in files:
+            try:
+                data = file.read_bytes() if size <= PREFETCH_SIZE else None
+            except OSError:
+                data = None
+            queue.put((arcname, file, size, data))
+    finally:
+        queue.put(None)
+
+
+def compress_tar_zst(files: list[tuple[str, Path, int]], dest: Path, level: int = ZSTD_LEVEL):
+    """
+    Stream files into a single zstd compressed tar archive.
+
+    The tar stream is piped straight into a multithreaded zstd compressor,
+    so nothing is staged on disk and compression scales with the cores.
+
+    :param files: (arcname, path, size) of the files to archive, sizes come
+        from the walk and only feed the progress total, each member header
+        is still built by tarfile from its own lstat (symlinks, owners)
+    :param dest: Path to the .tar.zst archive
+    :param level: zstd compression level
+    """
+    cctx = zstd.ZstdCompressor(level=level, threads=-1)
+    with new_progress(
+        BarColumn(),
+        "•",
+        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+        "•",
+        TransferSpeedColumn(),
+        "•",
+        TextColumn("[progress.description]{task.description}"),
+    ) as progress:
+        task = progress.add_task(
+            "[yellow]Compressing files...",
+            total=sum(size for _, _, size in files)
+        )
+
+        with open(dest, "wb", buffering=WRITE_BUFFER_SIZE) as fh, \
+                cctx.stream_writer(fh) as compressor, \
+                tarfile.open(
+                    fileobj=compressor,
+                    mode="w|",
+                    copybufsize=WRITE_BUFFER_SIZE
+                ) as tar:
+            # Disk reads overlap with compression, the queue caps memory use
+            queue = Queue(maxsize=8)
+            throttle = Throttle()
+            threading.Thread(
+                target=_prefetch_files, args=(files, queue), daemon=True
+            ).start()
+            while (item := queue.get()) is not None:
+                arcname, file, size, data = item
+                info = tar.gettarinfo(file, arcname=arcname)
+                if data is not None and info.isreg():
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                elif info.isreg():
+                    with open(file, "rb") as src:
+                        fadvise(src, FADV_SEQUENTIAL)
+                        tar.addfile(info, src)
+                        fadvise(src, FADV_DONTNEED)
+                else:
+                    tar.add(file, arcname=arcname)
+                progress.advance(task, size)
+                if throttle.ready():
+                    progress.update(
+                        task, description=f"[yellow]Compressed [bold]{file.name}.")
 
 
 def decompress_archive(src: Path, dest_folder: Path):
@@ -144,3 +380,202 @@ def decompress_archive(src: Path, dest_folder: Path):
     """
     with py7zr.SevenZipFile(src, 'r') as archive:
         archive.extractall(path=dest_folder)
+
+
+# ============ ZIP ============
+
+ZIP_COPY_SIZE = 1024 * 1024  # 1 MB, zipfile.write copies 8 KB at a time
+ZIP_LEVEL = 1  # near level 6 ratio on game data, several times faster
+ZIP_SAMPLE_SIZE = 64 * 1024  # 64 KB, enough to tell if DEFLATE is worth it
+
+
+def write_zip_member(zipf: zipfile.ZipFile, file: Path, arcname: str, compress_type: int):
+    """
+    Stream a file into an open zip, same entry as zipf.write but copied in
+    large chunks and always zip64 ready so big game files never overflow.
+    Deflated entries whose first 64 KB barely shrink are stored instead.
+    """
+    info = zipfile.ZipInfo.from_file(file, arcname)
+    info.compress_type = compress_type
+    info.compress_level = ZIP_LEVEL
+    # Unbuffered reads into one reused buffer, no bytes object per chunk
+    buffer = bytearray(min(ZIP_COPY_SIZE, max(info.file_size, 1)))
+    view = memoryview(buffer)
+    with open(file, "rb", buffering=0) as src:
+        fadvise(src, FADV_SEQUENTIAL)
+        head = src.read(ZIP_SAMPLE_SIZE)
+        if compress_type == zipfile.ZIP_DEFLATED and \
+                len(zipfile.zlib.compress(head, ZIP_LEVEL)) > len(head) * 0.95:
+            info.compress_type = zipfile.ZIP_STORED  # already compressed data
+        with zipf.open(info, "w", force_zip64=True) as dst:
+            dst.write(head)
+            while size := src.readinto(buffer):
+                dst.write(view[:size])
+        fadvise(src, FADV_DONTNEED)
+
+
+# ============ OBJECT STORE ============
+
+FICLONE = 0x40049409  # linux/fs.h, _IOW(0x94, 9, int)
+
+
+def clone_file(src, dst):
+    """
+    Copy a file, as a copy-on-write clone when the filesystem allows it.
+
+    On Btrfs/XFS the clone shares the source's extents, so no data is
+    written at all. Otherwise Linux copies in kernel with copy_file_range,
+    and anything else falls back to shutil.copy2. Hardlinks are not used on
+    purpose, an in place update of the source would silently change the
+    backup as well.
+    """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except OSError:
+                    if not hasattr(os, "copy_file_range"):
+                        raise
+                    # No reflink, still keep the data out of userspace
+                    copied = 0
+                    while sent := os.copy_file_range(fsrc.fileno(), fdst.fileno(), CHUNK_SIZE):
+                        copied += sent
+                    # Some filesystems (procfs, FUSE, network) report 0 up
+                    # front, an empty copy must never pass for the real file
+                    if copied != os.fstat(fsrc.fileno()).st_size:
+                        raise OSError("copy_file_range copied a short file")
+        except OSError:
+            pass  # not supported here, copy2 below overwrites dst
+        else:
+            shutil.copystat(src, dst)
+            return
+    shutil.copy2(src, dst)
+
+
+def find_blob(objects: Path, file_hash: str) -> Path | None:
+    """Return the stored blob for a hash, compressed or not, if any."""
+    folder = objects.joinpath(file_hash[:2], file_hash[2:4])
+    for blob in (folder.joinpath(f"{file_hash}.zst"), folder.joinpath(file_hash)):
+        if blob.exists():
+            return blob
+    return None
+
+
+_local = threading.local()
+ZSTD_MT_SIZE = 64 * 1024 * 1024  # 64 MB, smaller inputs do not split into enough zstd jobs
+_mt_slot = threading.Semaphore(1)  # one multithreaded compression at a time
+
+
+def _compressor(multithreaded: bool) -> zstd.ZstdCompressor:
+    """
+    zstd compressor of the calling thread. Contexts are not thread safe but
+    can be reused, so each store worker builds one and keeps it.
+
+    Small files are already spread over the store workers, so they get a
+    single threaded context. A big one would leave the other cores idle once
+    the small files are done, so it gets zstd's own worker threads.
+    """
+    threads = -1 if multithreaded else 0
+    key = f"cctx{threads}"
+    cctx = getattr(_local, key, None)
+    if cctx is None:
+        cctx = zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=threads)
+        setattr(_local, key, cctx)
+    return cctx
+
+
+def store_blob(path: Path, objects: Path, file_hash: str, compress: bool = True) -> Path:
+    """
+    Store a file in the object store under its BLAKE3 hash.
+
+    Nothing is written if a blob with the same hash already exists, so
+    unchanged files cost nothing past the hash on later backups.
+
+    :param path: File to store
+    :param objects: Root folder of the object store
+    :param file_hash: BLAKE3 hex digest of the file
+    :param compress: zstd compress the blob, disable for SKIP_EXT files
+    :return: Path to the stored blob
+    """
+    if blob := find_blob(objects, file_hash):
+        return blob
+
+    name = f"{file_hash}.zst" if compress else file_hash
+    blob = objects.joinpath(file_hash[:2], file_hash[2:4], name)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    temp = blob.with_name(f"{name}.tmp")
+    if compress:
+        # copy_stream keeps the read/compress/write loop in C, and the size
+        # goes into the frame header
+        with open(path, "rb") as src, open(temp, "wb") as dst:
+            fadvise(src, FADV_SEQUENTIAL)
+            size = os.fstat(src.fileno()).st_size
+            # Only one blob fans out over every core, other big ones that
+            # come meanwhile stay on their own worker thread
+            multithreaded = size >= ZSTD_MT_SIZE and _mt_slot.acquire(blocking=False)
+            try:
+                _compressor(multithreaded).copy_stream(
+                    src, dst,
+                    size=size,
+                    read_size=CHUNK_SIZE,
+                    write_size=WRITE_BUFFER_SIZE
+                )
+            finally:
+                if multithreaded:
+                    _mt_slot.release()
+            fadvise(src, FADV_DONTNEED)
+    else:
+        clone_file(path, temp)
+    os.replace(temp, blob)  # a half written blob never looks stored
+    return blob
+
+
+def restore_manifest(manifest: Path, dest_folder: Path):
+    """
+    Rebuild a backed up tree from a manifest and its object store.
+
+    :param manifest: Path to the manifest .json, objects/ sits next to it
+    :param dest_folder: Folder where files will be restored
+    """
+    objects = manifest.parent.joinpath("objects")
+    hashes = load_metadata(manifest).get("hashes", {})
+    dctx = zstd.ZstdDecompressor()
+
+    with new_progress(
+        BarColumn(),
+        "•",
+        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+        "•",
+        TextColumn("[progress.description]{task.description}"),
+    ) as progress:
+        task = progress.add_task(
+            "[yellow]Restoring files...", total=len(hashes))
+        for arcname, file_hash in hashes.items():
+            # A manifest is plain JSON, never let it write outside dest_folder
+            if Path(arcname).anchor or ".." in Path(arcname).parts:
+                print(f"[red]✖ Unsafe path {arcname}, skipped")
+                progress.update(task, advance=1)
+                continue
+
+            blob = find_blob(objects, file_hash)
+            if blob is None:
+                print(f"[red]✖ Missing blob for {arcname}")  # shown even with --quiet
+                progress.update(task, advance=1)
+                continue
+
+            target = dest_folder.joinpath(arcname)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if blob.suffix == ".zst":
+                with open(blob, "rb") as src, open(target, "wb") as dst:
+                    fadvise(src, FADV_SEQUENTIAL)
+                    dctx.copy_stream(
+                        src, dst, read_size=WRITE_BUFFER_SIZE, write_size=CHUNK_SIZE)
+                    fadvise(src, FADV_DONTNEED)
+            else:
+                clone_file(blob, target)
+            progress.update(
+                task,
+                description=f"[yellow]Restored [bold]{target.name}.",
+                advance=1
+            )